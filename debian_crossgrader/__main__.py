@@ -1,120 +1,166 @@
 """crossgrader entrypoint"""
+import operator
 import os
-from glob import glob
 import subprocess
+import sys
 import argparse
 import shutil
+import tempfile
+
+import apt_pkg
 
 from debian_crossgrader.crossgrader import Crossgrader
 from debian_crossgrader.utils import apt as apt_utils
 
-def first_stage(args):
+def create_crossgrader(args):
+    """Returns a Crossgrader for the given command line arguments."""
+    return Crossgrader(args.target_arch, skip_update=args.skip_apt_update,
+                       force_update=args.force_apt_update, unsafe_io=args.unsafe_io,
+                       assume_yes=args.yes)
+
+
+def ask_to_continue(args):
+    """Asks the user whether to continue, returning True if they agreed.
+
+    Does not ask if args.yes is set.
+    """
+    prompt = 'Do you want to continue [y/N]? '
+    if args.yes:
+        print(prompt + 'y')
+        return True
+
+    return input(prompt).lower() == 'y'
+
+
+def first_stage(args, crossgrader=None):
     """Runs first stage of the crossgrade process.
 
     Installs initramfs packages and packages with Priority: required/important.
     Does not need to be run if the target architecture can run the existing architecture.
+
+    Args:
+        args: Parsed command line arguments.
+        crossgrader: Crossgrader to use. If None, a new one is created for this stage.
+
+    Returns:
+        True if the first stage targets were crossgraded, False otherwise.
     """
-    with Crossgrader(args.target_arch) as crossgrader:
-        if args.packages:
-            targets = crossgrader.find_package_objs(args.packages, default_arch=args.target_arch)
+    if crossgrader is None:
+        with create_crossgrader(args) as crossgrader:
+            return first_stage(args, crossgrader)
+
+    if args.packages:
+        # names given by the user may be virtual packages of renamed packages
+        targets = crossgrader.find_package_objs(args.packages, default_arch=args.target_arch,
+                                                resolve_virtual=True)
+    else:
+        targets = crossgrader.list_first_stage_targets(
+            ignore_initramfs_remnants=args.force_initramfs,
+            ignore_unavailable_targets=args.force_unavailable
+        )
+
+    print('{} targets found.'.format(len(targets)))
+    # write the list at once instead of flushing it line by line on a terminal
+    sys.stdout.write(''.join(pkg.fullname + '\n'
+                             for pkg in sorted(targets, key=operator.attrgetter('fullname'))))
+
+    if args.dry_run:
+        return False
+
+    if ask_to_continue(args):
+        # cache qemu debs first because internet access might go down
+        # after crossgrade
+        # crossgrade qemu just if qemu-user-static exists for any arch
+        # pairs that can be run on the current arch but the current can't
+        # be run on the foreign arch
+        qemu_path_exists = os.path.isdir(crossgrader.qemu_deb_path)
+        crossgrade_qemu = crossgrader.qemu_installed or crossgrader.non_supported_arch
+        if crossgrade_qemu and not qemu_path_exists:
+            print('Saving qemu-user-static debs for second stage...')
+            qemu_pkgs = crossgrader.find_package_objs(['qemu-user-static', 'binfmt-support'],
+                                                      default_arch=args.target_arch)
+            crossgrader.cache_package_debs(qemu_pkgs, crossgrader.qemu_deb_path)
+            print('qemu-user-static saved.')
+
+        if args.download_only:
+            crossgrader.cache_package_debs(targets)
+            return False
         else:
-            targets = crossgrader.list_first_stage_targets(
-                ignore_initramfs_remnants=args.force_initramfs,
-                ignore_unavailable_targets=args.force_unavailable
+            # crossgrade dpkg/apt for correct crossgrading of Architecture: all packages that
+            # aren't marked M-A: foreign
+            pkg_packages = crossgrader.find_package_objs(
+                ['dpkg', 'apt', 'python3', 'python3-apt'],
+                default_arch=args.target_arch
             )
 
-        print('{} targets found.'.format(len(targets)))
-        for pkg_name in sorted(map(lambda pkg: pkg.fullname, targets)):
-            print(pkg_name)
-
-        if args.dry_run:
-            return
-
-        cont = input('Do you want to continue [y/N]? ').lower()
-        if cont == 'y':
-            # cache qemu debs first because internet access might go down
-            # after crossgrade
-            # crossgrade qemu just if qemu-user-static exists for any arch
-            # pairs that can be run on the current arch but the current can't
-            # be run on the foreign arch
-            qemu_path_exists = os.path.isdir(crossgrader.qemu_deb_path)
-            crossgrade_qemu = crossgrader.qemu_installed or crossgrader.non_supported_arch
-            if crossgrade_qemu and not qemu_path_exists:
-                print('Saving qemu-user-static debs for second stage...')
-                qemu_pkgs = crossgrader.find_package_objs(['qemu-user-static', 'binfmt-support'],
-                                                          default_arch=args.target_arch)
-                crossgrader.cache_package_debs(qemu_pkgs, crossgrader.qemu_deb_path)
-                print('qemu-user-static saved.')
-
-            if args.download_only:
-                crossgrader.cache_package_debs(targets)
-            else:
-                # crossgrade dpkg/apt for correct crossgrading of Architecture: all packages that
-                # aren't marked M-A: foreign
-                pkg_packages = crossgrader.find_package_objs(
-                    ['dpkg', 'apt', 'python3', 'python3-apt'],
-                    default_arch=args.target_arch
-                )
+            if not all(apt_utils.is_installed(pkg) for pkg in pkg_packages):
+                crossgrader.cache_package_debs(pkg_packages)
+                crossgrader.install_packages(fix_broken=False)
 
-                if not all(pkg.is_installed for pkg in pkg_packages):
-                    crossgrader.cache_package_debs(pkg_packages)
-                    crossgrader.install_packages(fix_broken=False)
+                # Force restart of the crossgrader so new version of python3
+                # and python3-apt is used
+                print('Crossgraded dpkg, apt, python3, and python3-apt.')
+                print('Please re-run the first stage to continue the crossgrade.')
+                return False
 
-                    # Force restart of the crossgrader so new version of python3
-                    # and python3-apt is used
-                    print('Crossgraded dpkg, apt, python3, and python3-apt.')
-                    print('Please re-run the first stage to continue the crossgrade.')
-                    return
+            crossgrader.cache_package_debs(targets)
+            # fix_broken should be disabled for first stage so apt doesn't
+            # decide to uninstall some necessary packages
+            crossgrader.install_packages(fix_broken=False)
+            subprocess.call(['update-initramfs', '-u', '-k', 'all'])
+            return True
+    else:
+        print('Aborted.')
 
-                crossgrader.cache_package_debs(targets)
-                # fix_broken should be disabled for first stage so apt doesn't
-                # decide to uninstall some necessary packages
-                crossgrader.install_packages(fix_broken=False)
-                subprocess.call(['update-initramfs', '-u', '-k', 'all'])
-        else:
-            print('Aborted.')
+    return False
 
 
-def second_stage(args):
+def second_stage(args, crossgrader=None):
     """Runs the second stage of the crossgrade process.
 
     Crossgrades all packages that are not in the target architecture.
+
+    Args:
+        args: Parsed command line arguments.
+        crossgrader: Crossgrader to use. If None, a new one is created for this stage.
     """
-    with Crossgrader(args.target_arch) as crossgrader:
-        # crossgrade qemu-user-static first to prevent list_second_stage_targets
-        # from finding it
-        if os.path.isdir(crossgrader.qemu_deb_path):
-            print('qemu-user-static must be crossgraded.')
-            if not args.dry_run:
-                cont = input('Do you want to continue [y/N]? ').lower()
-                if cont == 'y':
-                    print('Crossgrading saved qemu-user-static...')
-                    crossgrader.install_packages(
-                        glob(os.path.join(crossgrader.qemu_deb_path, '*.deb')),
-                        fix_broken=False
-                    )
-                    os.rmdir(crossgrader.qemu_deb_path)
-                    print('qemu-user-static successfully crossgraded.')
-            else:
-                print('qemu-user-static crossgrade skipped.')
+    if crossgrader is None:
+        with create_crossgrader(args) as crossgrader:
+            second_stage(args, crossgrader)
+        return
+
+    # crossgrade qemu-user-static first to prevent list_second_stage_targets
+    # from finding it
+    if os.path.isdir(crossgrader.qemu_deb_path):
+        print('qemu-user-static must be crossgraded.')
+        if not args.dry_run:
+            if ask_to_continue(args):
+                print('Crossgrading saved qemu-user-static...')
+                crossgrader.install_packages(
+                    apt_utils.list_debs(crossgrader.qemu_deb_path),
+                    fix_broken=False
+                )
+                os.rmdir(crossgrader.qemu_deb_path)
+                print('qemu-user-static successfully crossgraded.')
+        else:
+            print('qemu-user-static crossgrade skipped.')
 
-        targets = crossgrader.list_second_stage_targets(
-            ignore_unavailable_targets=args.force_unavailable
-        )
+    targets = crossgrader.list_second_stage_targets(
+        ignore_unavailable_targets=args.force_unavailable
+    )
 
-        print('{} targets found.'.format(len(targets)))
+    print('{} targets found.'.format(len(targets)))
 
-        if args.dry_run:
-            return
+    if args.dry_run:
+        return
 
-        cont = input('Do you want to continue [y/N]? ').lower()
-        if cont == 'y':
-            crossgrader.cache_package_debs(targets)
+    if ask_to_continue(args):
+        crossgrader.cache_package_debs(targets)
 
-            if not args.download_only:
-                crossgrader.install_packages()
-        else:
-            print('Aborted')
+        if not args.download_only:
+            crossgrader.install_packages()
+    else:
+        print('Aborted')
 
 
 def third_stage(args):
@@ -122,31 +168,40 @@ def third_stage(args):
 
     Removes all packages from the given architecture, excluding ones contained by args.packages.
     """
-    with Crossgrader(args.target_arch) as crossgrader:
+    with create_crossgrader(args) as crossgrader:
         foreign_arch = args.third_stage[0]
+        excluded = frozenset(args.packages or ())
+
         targets = apt_utils.get_arch_packages(foreign_arch)
-        if args.packages:
-            targets = [pkg_name for pkg_name in targets if pkg_name not in args.packages]
+        if excluded:
+            targets = [pkg_name for pkg_name in targets if pkg_name not in excluded]
 
         print('{} targets found.'.format(len(targets)))
-        for pkg_name in sorted(targets):
-            print(pkg_name)
+        sys.stdout.write(''.join(pkg_name + '\n' for pkg_name in sorted(targets)))
 
-        cont = input('Do you want to continue [y/N]? ').lower()
+        cont = ask_to_continue(args)
 
         if args.dry_run:
             return
 
-        if cont == 'y':
-            subprocess.check_call(['dpkg', '--purge'] + targets)
-            remaining = apt_utils.get_arch_packages(foreign_arch)
-            if args.packages:
-                remaining = [pkg_name for pkg_name in remaining if pkg_name not in args.packages]
+        if cont:
+            # let xargs read the targets from a file and build the command lines
+            # no -n: xargs only splits when the command line would be too long, as dpkg fails
+            # if a package is purged in an earlier call than the packages depending on it
+            with tempfile.NamedTemporaryFile('w') as targets_file:
+                targets_file.write('\0'.join(targets))
+                targets_file.flush()
+                subprocess.check_call(['xargs', '-0', '-r', '-a', targets_file.name,
+                                       'dpkg', '--purge'])
+
+            # query dpkg again, the purge changed the installed packages
+            # targets already exclude the excluded packages
+            remaining = set(apt_utils.get_arch_packages(foreign_arch)).intersection(targets)
 
             if remaining:
                 print('The following packages could not be successfully purged:')
-                for pkg_name in remaining:
-                    print('\t{}'.format(pkg_name))
+                sys.stdout.write(''.join('\t{}\n'.format(pkg_name)
+                                         for pkg_name in sorted(remaining)))
             else:
                 print('All targets successfully purged.')
                 print(('If desired, run dpkg --remove-architecture {} '
@@ -161,17 +216,15 @@ def third_stage(args):
 
 def install_from(args):
     """Installs all .debs from the specified location."""
-    with Crossgrader(args.target_arch) as crossgrader:
-        debs = glob(os.path.join(args.install_from, '*.deb'))
+    with create_crossgrader(args) as crossgrader:
+        debs = apt_utils.list_debs(args.install_from)
         print('Installing the following .debs:')
-        for deb in debs:
-            print('\t{}'.format(deb))
+        sys.stdout.write(''.join('\t{}\n'.format(deb) for deb in debs))
 
         if args.dry_run:
             return
 
-        cont = input('Do you want to continue [y/N]? ').lower()
-        if cont == 'y':
+        if ask_to_continue(args):
             crossgrader.install_packages(debs)
         else:
             print('Aborted.')
@@ -203,6 +256,12 @@ def get_argparser():
                         help=('Run the second stage of the crossgrading process '
                               '(crossgrading all remaining packages)'),
                         action='store_true')
+    parser.add_argument('--with-second-stage',
+                        help=('Run the second stage right after the first stage, reusing the '
+                              'package lists updated by the first stage. Only use this if the '
+                              'system does not need to be rebooted between the stages '
+                              '(e.g. amd64 to i386)'),
+                        action='store_true')
     parser.add_argument('--third-stage',
                         help=('Run the third stage of the crossgrading process '
                               '(removing all packages under specified arch)'),
@@ -231,6 +290,32 @@ def get_argparser():
                               'If used with --third-stage, the subsequent packages will '
                               'be excluded from removal'),
                         nargs='+')
+    parser.add_argument('--apt-proxy',
+                        help=('HTTP proxy used by APT to download package lists and packages '
+                              '(e.g. an apt-cacher-ng instance at http://127.0.0.1:3142)'),
+                        metavar='URL')
+    apt_update_group = parser.add_mutually_exclusive_group()
+    apt_update_group.add_argument('--skip-apt-update',
+                                  help=('Do not update APT\'s package lists. By default, they '
+                                        'are only updated if older than an hour. Can also be '
+                                        'set with the {} environment '
+                                        'variable').format(Crossgrader.SKIP_UPDATE_ENV_VAR),
+                                  action='store_true')
+    apt_update_group.add_argument('--force-apt-update',
+                                  help='Always update APT\'s package lists',
+                                  action='store_true')
+    parser.add_argument('--unsafe-io',
+                        help=('Install packages with dpkg --force-unsafe-io, only syncing '
+                              'once all packages are installed. Faster, but a crash during '
+                              'the installation can leave files empty or corrupt'),
+                        action='store_true')
+    parser.add_argument('--refresh-cache',
+                        help=('Discard the .debs kept from previous runs and download '
+                              'all packages again'),
+                        action='store_true')
+    parser.add_argument('-y', '--yes',
+                        help='Do not ask for confirmation, assume yes as the answer to all prompts',
+                        action='store_true')
     parser.add_argument('--dry-run',
                         help='Run the crossgrader, but do not change anything',
                         action='store_true')
@@ -250,6 +335,13 @@ def main():
         args.force_initramfs = True
         args.force_unavailable = True
 
+    if args.apt_proxy:
+        # the crossgrader passes it on to the apt-get calls it runs
+        apt_pkg.config.set('Acquire::http::Proxy', args.apt_proxy)
+
+    if args.refresh_cache and not args.cleanup:
+        Crossgrader.clear_deb_cache()
+
     if args.cleanup:
         cleanup()
     elif args.install_from:
@@ -258,6 +350,13 @@ def main():
         second_stage(args)
     elif args.third_stage:
         third_stage(args)
+    elif args.with_second_stage:
+        # share one Crossgrader between both stages so the package lists are only
+        # updated once and the architecture checks are not repeated
+        with create_crossgrader(args) as crossgrader:
+            if first_stage(args, crossgrader):
+                crossgrader.reload_cache()
+                second_stage(args, crossgrader)
     else:
         first_stage(args)
 
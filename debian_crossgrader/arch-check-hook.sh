@@ -21,5 +21,9 @@ check_file_arch () {
     fi
 }
 
-check_file_arch "${1}"
+# the hook is spliced into copy_exec, so do not return early; just skip the check
+# instead of failing for every copied file if python3 is no longer available
+if command -v python3 >/dev/null 2>&1; then
+    check_file_arch "${1}"
+fi
 # end arch-check-hook
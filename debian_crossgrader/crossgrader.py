@@ -6,21 +6,30 @@ Exceptions:
     PackageInstallationError: Package failed to be installed
     RemnantInitramfsHooksError: An initramfs hook could not be linked to an installed package
     PackageNotFoundError: Package couldn't be found in the target architecture
+    PackageDownloadError: Package .debs failed to be downloaded
 
 Classes:
     Crossgrader: contains tools to perform system crossgrade
 """
 
 
+import collections
+import concurrent.futures
+import errno
+import functools
 from glob import glob
+import hashlib
 import os
 import shutil
 import subprocess
 import sys
+import tempfile
+import time
 import traceback
 
 import appdirs
 import apt
+import apt_pkg
 
 from debian_crossgrader.utils import apt as apt_utils
 from debian_crossgrader.utils import cmd as cmd_utils
@@ -52,6 +61,19 @@ class PackageInstallationError(CrossgradingError):
         self.packages = packages
 
 
+class PackageDownloadError(CrossgradingError):
+    """Raised when the .debs of some packages could not be downloaded.
+
+    Attributes:
+        packages: A list of full names of packages that were not downloaded.
+    """
+
+    def __init__(self, packages):
+        super().__init__('An error occurred downloading the '
+                         'following packages: {}'.format(packages))
+        self.packages = packages
+
+
 class RemnantInitramfsHooksError(CrossgradingError):
     """Raised when not all initramfs hooks could be accounted for.
 
@@ -75,41 +97,80 @@ class Crossgrader:
         non_supported_arch: A boolean indicating whether the target arch is natively supported
             by the current CPU.
         qemu_installed: A boolean indicated whether or not qemu-user-static is installed.
+        unsafe_io: A boolean indicating whether dpkg skips syncing each unpacked package.
+        assume_yes: A boolean indicating whether prompts are answered with yes without asking.
 
         _apt_cache: python3-apt cache
+        _package_lookup: Packages already looked up by find_package_objs(_by_arch), by name
 
     Class attributes:
         initramfs_functions_backup_path: Path to the backup of hook-functions.
         arch_check_hook_path: Path to the arch-check-hook.sh shell script.
         qemu_deb_path: Path to a directory containing temporary cached qemu debs.
+        deb_cache_path: Path to a directory keeping downloaded .debs between runs.
+        apt_update_stamp_path: Path to a file touched after APT's package lists are updated.
 
     """
 
     APT_CACHE_DIR = '/var/cache/apt/archives'
+    APT_LISTS_DIR = '/var/lib/apt/lists'
+    # touched by apt.systemd.daily after a successful update
+    APT_PERIODIC_UPDATE_STAMP = '/var/lib/apt/periodic/update-success-stamp'
     DPKG_INFO_DIR = '/var/lib/dpkg/info'
     INITRAMFS_FUNCTIONS_PATH = '/usr/share/initramfs-tools/hook-functions'
+    INITRAMFS_HOOKS_DIR = '/usr/share/initramfs-tools/hooks'
 
     ARCH_CHECK_HOOK_NAME = 'arch-check-hook.sh'
     INITRAMFS_FUNCTIONS_BACKUP_NAME = 'hook-functions.bak'
     QEMU_DEB_DIR_NAME = 'qemu-debs'
+    DEB_CACHE_DIR_NAME = 'deb-cache'
+    APT_UPDATE_STAMP_NAME = 'apt-update-stamp'
 
     APP_NAME = 'debian_crossgrader'
     storage_dir = appdirs.site_data_dir(APP_NAME)
 
     FALLBACK_CROSSGRADER_DEPENDENCIES = ['python3', 'python3-apt']
 
+    # packages with these priorities are crossgraded in the first stage
+    FIRST_STAGE_PRIORITIES = frozenset(('required', 'important'))
+
+    # package lists updated less than APT_LISTS_TTL seconds ago are not updated again
+    APT_LISTS_TTL = 60 * 60
+    # package lists are not updated if this environment variable is non-empty
+    SKIP_UPDATE_ENV_VAR = 'DEBIAN_CROSSGRADER_SKIP_APT_UPDATE'
+
     # qemu_deb_path will be filled w/ qemu-user-static debs if self.non_supported_arch == True
     # during first stage
     # if it exists, its debs will be installed before second stage
     qemu_deb_path = os.path.join(storage_dir, QEMU_DEB_DIR_NAME)
     initramfs_functions_backup_path = os.path.join(storage_dir, INITRAMFS_FUNCTIONS_BACKUP_NAME)
+    # .debs downloaded by cache_package_debs are kept here until they are installed, so that
+    # they are not downloaded again by a later run (e.g. after --download-only or a restart
+    # of the first stage)
+    deb_cache_path = os.path.join(storage_dir, DEB_CACHE_DIR_NAME)
+    # the mtimes of the package lists come from the mirror, so the time of the last update
+    # is recorded separately
+    apt_update_stamp_path = os.path.join(storage_dir, APT_UPDATE_STAMP_NAME)
 
     script_dir = os.path.dirname(os.path.realpath(__file__))
     arch_check_hook_path = os.path.join(script_dir, ARCH_CHECK_HOOK_NAME)
 
-    def __init__(self, target_architecture):
+    def __init__(self, target_architecture, skip_update=False, force_update=False,
+                 unsafe_io=False, assume_yes=False):
         """Inits Crossgrader with the given target architecture.
 
+        Args:
+            target_architecture: The architecture to crossgrade to.
+            skip_update: If true, do not update APT's package lists. They are also not
+                updated if they are newer than APT_LISTS_TTL seconds and already
+                contain the target architecture, or if the SKIP_UPDATE_ENV_VAR
+                environment variable is set to a non-empty value.
+            force_update: If true, always update APT's package lists, overriding
+                skip_update.
+            unsafe_io: If true, install packages with dpkg --force-unsafe-io and only
+                sync the file systems once all packages are installed.
+            assume_yes: If true, answer yes to prompts instead of asking the user.
+
         Raises:
             InvalidArchitectureError: The given target_architecture is not recognized
                 by dpkg.
@@ -123,9 +184,7 @@ class Crossgrader:
         except PermissionError:
             raise PermissionError('crossgrader: must be superuser.')
 
-        valid_architectures = subprocess.check_output(['dpkg-architecture', '--list-known'],
-                                                      universal_newlines=True).splitlines()
-        if target_architecture not in valid_architectures:
+        if target_architecture not in self._valid_architectures():
             raise InvalidArchitectureError(
                 'Architecture {} is not recognized by dpkg.'.format(target_architecture)
             )
@@ -135,30 +194,13 @@ class Crossgrader:
         self.current_arch = subprocess.check_output(['dpkg', '--print-architecture'],
                                                     universal_newlines=True).strip()
         self.target_arch = target_architecture
+        # packages in these architectures never need to be crossgraded
+        self._skipped_archs = frozenset(('all', self.target_arch))
 
-        arch_test_ret = subprocess.call(['arch-test', '-n', self.target_arch],
-                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        if arch_test_ret != 0:
-            if arch_test_ret == 2:
-                # no need to throw an error here, qemu-user-static should be able to handle it
-                print(('arch-test lacks a helper for {}; assuming not supported on this machine '
-                       'but runnable with emulation.').format(self.target_arch))
-            elif arch_test_ret == 1:
-                # ensure target arch can be run with emulation for foreign package setup
-                support_with_emu = subprocess.call(['arch-test', self.target_arch],
-                                                   stdout=subprocess.DEVNULL,
-                                                   stderr=subprocess.DEVNULL) == 0
-                if not support_with_emu:
-                    raise InvalidArchitectureError(
-                        ('Architecture {} is not runnable on this machine. Please install '
-                         'qemu-user-static and try again.').format(self.target_arch)
-                    )
-            else:
-                raise CrossgradingError('Ensure arch-test is installed.')
-
-            self.non_supported_arch = True
-        else:
-            self.non_supported_arch = False
+        # if dpkg is already in the target architecture (e.g. in the second and third stages),
+        # the target architecture is known to be runnable, at least with emulation
+        check_emulation = self.target_arch != self.current_arch
+        self.non_supported_arch = not self._target_arch_native(check_emulation)
 
         if self.non_supported_arch:
             print(('Architecture {} is not natively supported '
@@ -170,16 +212,108 @@ class Crossgrader:
         else:
             print('Hook installation failed.')
 
+        self.unsafe_io = unsafe_io
+        self.assume_yes = assume_yes
+
+        self._package_lookup = {}
+
         self._apt_cache = apt.Cache()
-        try:
-            self._apt_cache.update(apt.progress.text.AcquireProgress())
-            self._apt_cache.open()  # re-open to utilise new cache
-        except apt.cache.FetchFailedException:
-            traceback.print_exc()
-            print('Ignoring...')
+        skip_update = skip_update or bool(os.environ.get(self.SKIP_UPDATE_ENV_VAR))
+        if not force_update and (skip_update or self._apt_lists_fresh()):
+            print('Skipping APT package list update.')
+        else:
+            try:
+                self._apt_cache.update(apt.progress.text.AcquireProgress())
+                self._touch_apt_update_stamp()
+                self._apt_cache.open()  # re-open to utilise new cache
+            except apt.cache.FetchFailedException:
+                traceback.print_exc()
+                print('Ignoring...')
 
         self.qemu_installed = self._apt_cache['qemu-user-static'].is_installed
 
+    def _target_arch_native(self, check_emulation=True):
+        """Returns whether the target architecture is natively supported by the current CPU.
+
+        Args:
+            check_emulation: If true, also ensure that the target architecture can be run
+                with emulation if it is not natively supported.
+
+        Raises:
+            InvalidArchitectureError: The target architecture can neither be run natively
+                nor with emulation.
+            CrossgradingError: arch-test is not installed.
+        """
+        arch_test_ret = subprocess.call(['arch-test', '-n', self.target_arch],
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if arch_test_ret == 0:
+            return True
+
+        if arch_test_ret in (1, 2) and not check_emulation:
+            return False
+
+        if arch_test_ret == 2:
+            # no need to throw an error here, qemu-user-static should be able to handle it
+            print(('arch-test lacks a helper for {}; assuming not supported on this machine '
+                   'but runnable with emulation.').format(self.target_arch))
+        elif arch_test_ret == 1:
+            # ensure target arch can be run with emulation for foreign package setup
+            support_with_emu = subprocess.call(['arch-test', self.target_arch],
+                                               stdout=subprocess.DEVNULL,
+                                               stderr=subprocess.DEVNULL) == 0
+            if not support_with_emu:
+                raise InvalidArchitectureError(
+                    ('Architecture {} is not runnable on this machine. Please install '
+                     'qemu-user-static and try again.').format(self.target_arch)
+                )
+        else:
+            raise CrossgradingError('Ensure arch-test is installed.')
+
+        return False
+
+    @staticmethod
+    @functools.lru_cache(maxsize=1)
+    def _valid_architectures():
+        """Returns a frozenset of all architectures known by dpkg.
+
+        dpkg-architecture is only run once per process, as its output does not change.
+        """
+        return frozenset(subprocess.check_output(['dpkg-architecture', '--list-known'],
+                                                 universal_newlines=True).splitlines())
+
+    def _apt_lists_fresh(self):
+        """Checks whether APT's package lists are recent enough to skip updating them.
+
+        The lists' own mtimes cannot be used, as APT sets them to the Last-Modified time
+        reported by the mirror instead of the time of the update.
+
+        Returns:
+            True if the crossgrader or apt.systemd.daily updated the package lists within
+            APT_LISTS_TTL seconds and package lists for the target architecture exist,
+            False otherwise.
+        """
+        update_times = []
+        for stamp in (self.apt_update_stamp_path, self.APT_PERIODIC_UPDATE_STAMP):
+            try:
+                update_times.append(os.path.getmtime(stamp))
+            except FileNotFoundError:
+                pass
+
+        if not update_times or time.time() - max(update_times) >= self.APT_LISTS_TTL:
+            return False
+
+        # the target architecture may have just been added, in which case
+        # its package lists have never been downloaded
+        target_lists = os.path.join(self.APT_LISTS_DIR,
+                                    '*_binary-{}_Packages*'.format(self.target_arch))
+        return bool(glob(target_lists))
+
+    def _touch_apt_update_stamp(self):
+        """Records that APT's package lists were just updated successfully."""
+        os.makedirs(self.storage_dir, exist_ok=True)
+        with open(self.apt_update_stamp_path, 'a'):
+            os.utime(self.apt_update_stamp_path, None)
+
     def __enter__(self):
         """Enter the with statement"""
         return self
@@ -192,6 +326,14 @@ class Crossgrader:
         """Close the package cache"""
         self._apt_cache.close()
 
+    def reload_cache(self):
+        """Re-read the package cache without updating APT's package lists.
+
+        Needed after installing packages so their new state is visible to the cache.
+        """
+        self._apt_cache.open()
+        self._package_lookup.clear()
+
     def create_initramfs_arch_check(self):
         """Inserts the contents of arch-check-hook.sh into the copy_exec function.
 
@@ -201,7 +343,8 @@ class Crossgrader:
 
         If the arch check hook already exists, then it is not copied.
 
-        The arch-test package must be installed for the hook to function.
+        The hook runs debian_crossgrader.utils.elf with python3, and is skipped
+        if python3 is not available.
 
         Returns:
             True if the hook was successfully installed, False otherwise.
@@ -211,35 +354,60 @@ class Crossgrader:
             print('hook-functions file does not exist.')
             return False
 
-        with open(self.INITRAMFS_FUNCTIONS_PATH, 'r') as functions_file:
-            functions_lines = functions_file.read().splitlines()
-
-        # is there a better way than using a magic string?
-        if '# begin arch-check-hook' in functions_lines:
-            print('arch check hook already installed.')
-            return False
+        arch_hook_bytes = self._read_arch_hook(self.target_arch)
 
-        shutil.copy2(self.INITRAMFS_FUNCTIONS_PATH, self.initramfs_functions_backup_path)
-        assert os.path.isfile(self.initramfs_functions_backup_path)
-        print('Backed up hook-functions to {}'.format(self.initramfs_functions_backup_path))
+        # write the new hook-functions next to the old one so it can be atomically replaced
+        functions_dir = os.path.dirname(self.INITRAMFS_FUNCTIONS_PATH)
+        new_functions_file = tempfile.NamedTemporaryFile('wb', dir=functions_dir, delete=False)
+        hook_inserted = False
+        try:
+            # copy the lines as bytes, there is no need to decode them
+            with open(self.INITRAMFS_FUNCTIONS_PATH, 'rb') as functions_file, new_functions_file:
+                for line in functions_file:
+                    # is there a better way than using a magic string?
+                    if b'# begin arch-check-hook' in line:
+                        print('arch check hook already installed.')
+                        return False
+
+                    new_functions_file.write(line)
+
+                    # only match a whole line so that other functions ending in copy_exec
+                    # are skipped
+                    if not hook_inserted and line == b'copy_exec() {\n':
+                        new_functions_file.write(arch_hook_bytes)
+                        hook_inserted = True
+
+            if not hook_inserted:
+                print('Could not find copy_exec function definition.')
+                return False
+
+            # back up only now that the original is known to not contain the hook
+            shutil.copy2(self.INITRAMFS_FUNCTIONS_PATH, self.initramfs_functions_backup_path)
+            assert os.path.isfile(self.initramfs_functions_backup_path)
+            print('Backed up hook-functions to {}'.format(self.initramfs_functions_backup_path))
+
+            shutil.copymode(self.INITRAMFS_FUNCTIONS_PATH, new_functions_file.name)
+            os.replace(new_functions_file.name, self.INITRAMFS_FUNCTIONS_PATH)
+        finally:
+            if os.path.exists(new_functions_file.name):
+                os.remove(new_functions_file.name)
 
-        with open(self.arch_check_hook_path, 'r') as arch_hook_file:
-            arch_hook_lines = arch_hook_file.read().splitlines()
-        for idx, line in enumerate(arch_hook_lines):
-            arch_hook_lines[idx] = line.replace('TARGET_ARCH_PLACEHOLDER', self.target_arch)
+        return True
 
-        try:
-            hook_index = functions_lines.index('copy_exec() {') + 1
-        except ValueError:
-            print('Could not find copy_exec function definition.')
-            return False
+    @classmethod
+    @functools.lru_cache(maxsize=None)
+    def _read_arch_hook(cls, target_arch):
+        """Returns the contents of arch-check-hook.sh for the given target architecture as bytes.
 
-        functions_lines = functions_lines[:hook_index] + arch_hook_lines + \
-                          functions_lines[hook_index + 1:]
-        with open(self.INITRAMFS_FUNCTIONS_PATH, 'w') as functions_file:
-            functions_file.write('\n'.join(functions_lines))
+        The result always ends in a newline.
+        """
+        with open(cls.arch_check_hook_path, 'rb') as arch_hook_file:
+            arch_hook_bytes = arch_hook_file.read().replace(b'TARGET_ARCH_PLACEHOLDER',
+                                                            os.fsencode(target_arch))
+        if not arch_hook_bytes.endswith(b'\n'):
+            arch_hook_bytes += b'\n'
 
-        return True
+        return arch_hook_bytes
 
     @staticmethod
     def remove_initramfs_arch_check():
@@ -261,20 +429,27 @@ class Crossgrader:
             print('Backup file does not exist.')
             return False
 
-        with open(Crossgrader.INITRAMFS_FUNCTIONS_PATH, 'r') as functions_file:
-            functions_lines = functions_file.read().splitlines()
+        # stop reading at the marker instead of splitting the whole file into lines
+        with open(Crossgrader.INITRAMFS_FUNCTIONS_PATH, 'rb') as functions_file:
+            hook_installed = any(line.rstrip(b'\n') == b'# begin arch-check-hook'
+                                 for line in functions_file)
 
-        if '# begin arch-check-hook' not in functions_lines:
+        if not hook_installed:
             print('arch check hook not installed.')
             return False
 
-        shutil.copy2(Crossgrader.initramfs_functions_backup_path,
-                     Crossgrader.INITRAMFS_FUNCTIONS_PATH)
-        os.remove(Crossgrader.initramfs_functions_backup_path)
+        try:
+            os.replace(Crossgrader.initramfs_functions_backup_path,
+                       Crossgrader.INITRAMFS_FUNCTIONS_PATH)
+        except OSError as exc:
+            if exc.errno != errno.EXDEV:
+                raise
+            # backup is on a different filesystem, so it can't be renamed
+            shutil.move(Crossgrader.initramfs_functions_backup_path,
+                        Crossgrader.INITRAMFS_FUNCTIONS_PATH)
         return True
 
-    @staticmethod
-    def _fix_dpkg_errors(packages):
+    def _fix_dpkg_errors(self, packages):
         """Tries to fix the given packages that dpkg failed to install.
 
         First, run apt install -f.
@@ -291,32 +466,42 @@ class Crossgrader:
 
         print('Running apt-get --fix-broken install...')
         # let user select yes/no
-        ret_code = subprocess.call(['apt-get', 'install', '-f', '-y'])
+        ret_code = subprocess.call(self._apt_get_command('install', '-f', '-y'))
         if ret_code == 0:
             return True
 
         print('apt-get --fix-broken install failed.')
-        print('Removing all coinstalled packages...')
-        for package in packages:
-            package_status_proc = subprocess.Popen(['dpkg', '-s', package],
-                                                   stdout=subprocess.PIPE, stderr=sys.stderr,
-                                                   universal_newlines=True)
-            package_status, __ = package_status_proc.communicate()
-            if 'Multi-Arch: same' not in package_status:
-                continue
 
-            # architecture should be specified for M-A: same packages
-            assert ':' in package
+        # read the states of all packages with one dpkg-query call, which is cheaper
+        # than re-opening the cache after the installation and apt-get changed them
+        package_info = apt_utils.get_installed_package_info('Multi-Arch')
+        multi_arch_same = {name + ':' + arch for name, arch, multi_arch in package_info
+                           if multi_arch == 'same'}
+        # dpkg always specifies the architecture of M-A: same packages
+        failed_packages = [package for package in packages if package in multi_arch_same]
+
+        # only collect the instances of the few names that failed
+        installed_fullnames = {package.partition(':')[0]: [] for package in failed_packages}
+        for name, arch, __ in package_info:
+            if name in installed_fullnames:
+                installed_fullnames[name].append(name + ':' + arch)
+
+        to_remove = []
+        for package in failed_packages:
+            short_name = package.partition(':')[0]
+            for fullname in installed_fullnames[short_name]:
+                if fullname != package and fullname not in to_remove:
+                    to_remove.append(fullname)
 
-            short_name = package[:package.index(':')]
-            coinstalled = subprocess.check_output(['dpkg-query', '-f',
-                                                   '${Package}:${Architecture}\n', '-W',
-                                                   short_name],
-                                                  universal_newlines=True).splitlines()
-            for coinstalled_package in coinstalled:
-                if coinstalled_package == package:
-                    continue
+        print('Removing all coinstalled packages...')
+        # try removing everything with a single dpkg call first
+        ret_code = 0
+        if to_remove:
+            ret_code = subprocess.call(['dpkg', '--remove', '--force-depends'] + to_remove)
 
+        if ret_code != 0:
+            print('dpkg failed to remove the coinstalled packages, removing them one by one...')
+            for coinstalled_package in to_remove:
                 ret_code = subprocess.call(['dpkg', '--remove', '--force-depends',
                                             coinstalled_package])
                 if ret_code == 0:
@@ -333,7 +518,12 @@ class Crossgrader:
 
                 if os.path.isfile(prerm_script):
                     print('prerm script found: {}'.format(prerm_script))
-                    cont = input('Remove prerm script and try again [Y/n]? ').lower()
+                    prompt = 'Remove prerm script and try again [Y/n]? '
+                    if self.assume_yes:
+                        print(prompt + 'y')
+                        cont = 'y'
+                    else:
+                        cont = input(prompt).lower()
                     if cont == 'y' or not cont:
                         os.remove(prerm_script)
                         ret_code = subprocess.call(['dpkg', '--remove', '--force-depends',
@@ -347,14 +537,31 @@ class Crossgrader:
             return False
 
         print('Running apt-get --fix-broken install...')
-        ret_code = subprocess.call(['apt-get', 'install', '-f'])
+        fix_broken_cmd = self._apt_get_command('install', '-f')
+        if self.assume_yes:
+            fix_broken_cmd.append('-y')
+        ret_code = subprocess.call(fix_broken_cmd)
         if ret_code == 0:
             return True
 
         return False
 
     @staticmethod
-    def _install_and_configure(debs_to_install):
+    def _apt_get_command(*args):
+        """Returns an apt-get command line with the given arguments.
+
+        apt-get does not see python-apt's configuration in this process, so a proxy
+        set there (e.g. with --apt-proxy) is passed on explicitly.
+        """
+        apt_get_cmd = ['apt-get']
+        proxy = apt_pkg.config.find('Acquire::http::Proxy')
+        if proxy:
+            apt_get_cmd += ['-o', 'Acquire::http::Proxy={}'.format(proxy)]
+
+        return apt_get_cmd + list(args)
+
+    @staticmethod
+    def _install_and_configure(debs_to_install, dpkg_options=()):
         """Runs one pass of dpkg -i and dpkg --configure -a on the input .deb files.
 
         dpkg outputs failures in two ways: the .deb file that failed,
@@ -367,32 +574,45 @@ class Crossgrader:
         package names are outputted if the installation didn't completely fail.
         The errors should be fixed, and then dpkg --configure -a should be run.
 
+        Args:
+            debs_to_install: A list of paths to .deb files.
+            dpkg_options: Additional options passed to both dpkg calls.
+
         Returns:
-            A list of .debs that failed to be installed, and a list of packages
+            A set of .debs that failed to be installed, and a set of packages
             that failed to be installed.
         """
 
-        def get_dpkg_failures(dpkg_errs):
-            """Returns a tuple of (failed_debs, failed_packages) parsed from dpkg's stderr."""
-            debs = set()
-            packages = set()
+        failed_debs = set()
+        failed_packages = set()
+
+        def dpkg_failure_parser():
+            """Returns a callback that records failures from dpkg's stderr, one line at a time.
 
+            Failures are listed as indented lines after dpkg's
+            'Errors were encountered while processing:' header. Lines are matched as
+            bytes, and only the failed names are decoded.
+            """
             capture_packages = False
 
-            for line in dpkg_errs:
-                line = line.strip()
+            def parse_line(line):
+                nonlocal capture_packages
 
                 if capture_packages:
-                    if line.endswith('.deb'):
-                        assert os.path.isfile(line), '{} does not exist'.format(line)
-                        debs.add(line)
-                    else:
-                        packages.add(line)
+                    if line[:1].isspace():
+                        name = os.fsdecode(line.strip())
+                        if name.endswith('.deb'):
+                            failed_debs.add(name)
+                        else:
+                            failed_packages.add(name)
+                        return
 
-                if line == 'Errors were encountered while processing:':
+                    capture_packages = False
+
+                if line.rstrip(b'\n') == b'Errors were encountered while processing:':
                     capture_packages = True
 
-            return debs, packages
+            return parse_line
 
         # set max error count so dpkg does not abort from too many errors
         # multiply by 2 because a package can have multiple errors
@@ -400,36 +620,31 @@ class Crossgrader:
 
         error_count_option = '--abort-after={}'.format(max_error_count)
 
-        proc = subprocess.Popen(['dpkg', '-i', error_count_option] + debs_to_install,
-                                stdout=sys.stdout, stderr=subprocess.PIPE,
-                                universal_newlines=True)
-        __, __, errs = cmd_utils.tee_process(proc)
+        dpkg_cmd = ['dpkg', error_count_option] + list(dpkg_options)
 
-        failed_debs, failed_packages = get_dpkg_failures(errs.splitlines())
+        proc = subprocess.Popen(dpkg_cmd + ['-i'] + debs_to_install,
+                                stdout=sys.stdout, stderr=subprocess.PIPE)
+        cmd_utils.tee_stderr_lines(proc, dpkg_failure_parser())
 
         print('Running dpkg --configure -a...')
-        proc = subprocess.Popen(['dpkg', '--configure', '-a', error_count_option],
-                                stdout=sys.stdout, stderr=subprocess.PIPE,
-                                universal_newlines=True)
-        __, __, errs = cmd_utils.tee_process(proc)
-
-        new_failed_debs, new_failed_packages = get_dpkg_failures(errs.splitlines())
-        failed_debs.update(new_failed_debs)
-        failed_packages.update(new_failed_packages)
+        proc = subprocess.Popen(dpkg_cmd + ['--configure', '-a'],
+                                stdout=sys.stdout, stderr=subprocess.PIPE)
+        cmd_utils.tee_stderr_lines(proc, dpkg_failure_parser())
 
-        return list(failed_debs), list(failed_packages)
+        return failed_debs, failed_packages
 
     @staticmethod
-    def _install_configure_loop(debs_to_install):
+    def _install_configure_loop(debs_to_install, dpkg_options=()):
         """
         Repeatedly runs _install_and_configure until all .debs are installed or
         failures stop decreasing.
 
         Args:
             debs_to_install: A list of paths to .deb files.
+            dpkg_options: Additional options passed to each dpkg call.
 
         Returns:
-            A list of packages that were not successfully installed.
+            A set of packages that were not successfully installed, or None if no .debs were given.
 
         Raises:
             PackageInstallationError: Some of the packages were not successfully
@@ -457,19 +672,21 @@ class Crossgrader:
             loop_count += 1
             print('dpkg -i/--configure loop #{}'.format(loop_count))
 
-            failed_debs, failed_packages = Crossgrader._install_and_configure(debs_remaining)
+            failed_debs, failed_packages = Crossgrader._install_and_configure(debs_remaining,
+                                                                              dpkg_options)
 
             for deb in debs_remaining:
                 if deb not in failed_debs:
-                    os.remove(deb)
+                    os.unlink(deb)
 
             assert len(failed_debs) <= len(debs_remaining)
 
             if len(failed_debs) == len(debs_remaining):
                 print('Number of failed installs did not decrease, halting...')
-                raise PackageInstallationError(failed_debs)
+                raise PackageInstallationError(sorted(failed_debs))
 
-            debs_remaining = failed_debs
+            # keep the installation order of the remaining .debs
+            debs_remaining = [deb for deb in debs_remaining if deb in failed_debs]
 
             if debs_remaining:
                 print('The following .deb files were not fully installed, retrying...')
@@ -478,8 +695,7 @@ class Crossgrader:
 
         return failed_packages
 
-    @staticmethod
-    def install_packages(debs_to_install=None, fix_broken=True):
+    def install_packages(self, debs_to_install=None, fix_broken=True):
         """Installs specified .deb files.
 
         Installs the .deb files specified in packages_to_install
@@ -495,58 +711,92 @@ class Crossgrader:
                 installed/configured.
         """
         if debs_to_install is None:
-            debs_to_install = glob(os.path.join(Crossgrader.APT_CACHE_DIR, '*.deb'))
+            debs_to_install = apt_utils.list_debs(Crossgrader.APT_CACHE_DIR)
+
+        if not debs_to_install:
+            print('No .debs to install.')
+            return
 
         # find all packages marked as autoinstalled, and match them to the newly installed ones
-        # apt-mark shows packages in native architecture without colon and others with
         print('Parsing automatically installed packages...')
-        proc = subprocess.Popen(['apt-mark', 'showauto'], stdout=subprocess.PIPE,
-                                universal_newlines=True)
-        auto_pkgs_list, __ = proc.communicate()
-        auto_pkgs_list = auto_pkgs_list.splitlines()
-
-        ret_code = proc.returncode
-        assert ret_code == 0, 'apt-mark showauto failed with code {}'.format(ret_code)
 
         # to handle packages installed in non-native architectures
         # (e.g. all native packages during second stage), strip all architectures from the
-        # packages returned by apt-mark
+        # automatically installed packages
         # therefore, if any existing package with the same name is auto-installed,
         # then the newly installed one will be auto-installed as well
-        auto_pkgs = set()
-        for pkg in auto_pkgs_list:
-            try:
-                auto_pkgs.add(pkg[:pkg.index(':')])
-            except ValueError:
-                auto_pkgs.add(pkg)
+        auto_pkgs = frozenset(pkg.partition(':')[0]
+                              for pkg in apt_utils.get_auto_installed_fullnames())
 
         # must find such packages before they are installed because dpkg -i will re-mark
         # them as manually installed
         mark_auto_pkgs = []
         for deb in debs_to_install:
-            proc = subprocess.Popen(
-                ['dpkg-deb', '--showformat=${Package}:${Architecture}', '-W', deb],
-                stdout=subprocess.PIPE, universal_newlines=True
-            )
-            pkg_full_name, __ = proc.communicate()
-
-            ret_code = proc.returncode
-            assert ret_code == 0, 'dpkg-deb failed with code {}'.format(ret_code)
+            pkg_full_name = apt_utils.get_deb_fullname(deb)
 
-            pkg_short_name = pkg_full_name[:pkg_full_name.index(':')]
+            pkg_short_name = pkg_full_name.partition(':')[0]
             if pkg_short_name in auto_pkgs:
                 mark_auto_pkgs.append(pkg_full_name)
         print('...done')
 
-        failed_packages = Crossgrader._install_configure_loop(debs_to_install)
+        dpkg_options = ['--force-unsafe-io'] if self.unsafe_io else []
+        try:
+            failed_packages = Crossgrader._install_configure_loop(debs_to_install, dpkg_options)
+        finally:
+            # installed .debs are unlinked, so their cached copies are no longer needed
+            self._forget_cached_debs(deb for deb in debs_to_install if not os.path.exists(deb))
 
-        if fix_broken and not Crossgrader._fix_dpkg_errors(failed_packages):
+        if self.unsafe_io:
+            # dpkg did not sync the unpacked files, do it once for all of them
+            print('Syncing file systems...')
+            os.sync()
+
+        if fix_broken and not self._fix_dpkg_errors(failed_packages):
             print('Some dpkg errors could not be fixed automatically.')
 
-        print('Re-marking packages as auto-installed...')
-        ret_code = subprocess.call(['apt-mark', 'auto'] + mark_auto_pkgs,
-                                   stdout=subprocess.DEVNULL)
-        print('...done')
+        if mark_auto_pkgs:
+            print('Re-marking packages as auto-installed...')
+            unmarked_pkgs = self._mark_packages_auto(mark_auto_pkgs)
+            if unmarked_pkgs:
+                print('The following packages could not be marked as auto-installed:')
+                for pkg in unmarked_pkgs:
+                    print('\t{}'.format(pkg))
+            print('...done')
+
+    @staticmethod
+    def _mark_packages_auto(packages):
+        """Marks the given packages as automatically installed using apt-mark.
+
+        All packages are passed to apt-mark at once, only split if the command line
+        would be too long. If apt-mark fails, the packages that were not marked are
+        retried one at a time.
+
+        Args:
+            packages: A list of package full names.
+
+        Returns:
+            A list of packages that could not be marked.
+        """
+        mark_cmd = ['apt-mark', 'auto']
+        mark_failed = False
+        for batch in cmd_utils.chunk_args(packages, mark_cmd):
+            if subprocess.call(mark_cmd + batch, stdout=subprocess.DEVNULL) != 0:
+                mark_failed = True
+
+        if not mark_failed:
+            return []
+
+        auto_pkgs = apt_utils.get_auto_installed_fullnames()
+
+        unmarked_pkgs = []
+        for pkg in packages:
+            if pkg in auto_pkgs:
+                continue
+
+            if subprocess.call(mark_cmd + [pkg], stdout=subprocess.DEVNULL) != 0:
+                unmarked_pkgs.append(pkg)
+
+        return unmarked_pkgs
 
     def cache_package_debs(self, targets, target_dir=None):
         """Cache specified packages.
@@ -557,6 +807,9 @@ class Crossgrader:
         Args:
             targets: A list of apt.package.Package objects to crossgrade.
             target_dir: If target_dir set, move all cached .debs the given directory.
+
+        Raises:
+            PackageDownloadError: A package that could not be marked failed to download.
         """
 
 
@@ -567,107 +820,287 @@ class Crossgrader:
         # use python-apt to cache .debs for package and dependencies
         # because apt-get --download-only install will not download
         # if it can't find a good way to resolve dependencies
-        for target in targets:
-            if target.is_installed:
-                continue
+        # defer APT's bookkeeping of the cache state until all targets are marked
+        failed_targets = []
+        with self._apt_cache.actiongroup():
+            for target in targets:
+                if apt_utils.is_installed(target):
+                    continue
+
+                target.mark_install(auto_fix=False)  # do not try to fix broken packages
+                if not target.marked_install:
+                    failed_targets.append(target)
 
-            target.mark_install(auto_fix=False)  # do not try to fix broken packages
+        unmarked_targets = []
+        for target in failed_targets:
+            if target.marked_install:
+                # marked as a dependency of a later target
+                continue
 
             # some packages (python3-apt) refuses to mark as install for some reason
+            print(('Could not mark {} for install, '
+                   'fixing manually.').format(target.fullname))
+            target.mark_install(auto_fix=False, auto_inst=False)
+
+            # download the .deb directly if it still can't be marked
             if not target.marked_install:
-                print(('Could not mark {} for install, '
-                       'fixing manually.').format(target.fullname))
-                target.mark_install(auto_fix=False, auto_inst=False)
-                assert target.marked_install, \
-                       '{} not marked as install despite no auto_inst'.format(target.fullname)
+                unmarked_targets.append(target)
 
         __, __, free_space = shutil.disk_usage(self.APT_CACHE_DIR)
 
-        required_space = 0
-        for package in self._apt_cache:
-            if package.marked_install:
-                required_space += package.candidate.installed_size
-                required_space += package.candidate.size
+        # only walk the packages with pending changes instead of the whole cache
+        marked_packages = [package for package in self._apt_cache.get_changes()
+                           if package.marked_install]
+
+        required_space = sum(package.candidate.installed_size + package.candidate.size
+                             for package in marked_packages + unmarked_targets)
 
         if required_space > free_space:
             raise NotEnoughSpaceError(
                 '{} bytes free but {} bytes required'.format(free_space, required_space)
             )
 
+        # APT does not download .debs that already exist in its archives directory
+        # fetch_binary() uses the file name from the repository instead
+        self._restore_cached_debs(
+            [(apt_utils.get_archive_filename(package.candidate), package.candidate)
+             for package in marked_packages] +
+            [(os.path.basename(package.candidate.filename), package.candidate)
+             for package in unmarked_targets]
+        )
+
         # fetch_archives() throws a more detailed error if a specific package
         # could not be downloaded for some reason.
         # Do not check its return value; it is undefined.
         self._apt_cache.fetch_archives()
 
+        if unmarked_targets:
+            self._fetch_unmarked_debs(unmarked_targets)
+
         self._apt_cache.clear()
 
+        self._store_cached_debs()
+
         if target_dir is not None:
             os.makedirs(target_dir, exist_ok=True)
 
-            for deb in glob(os.path.join(Crossgrader.APT_CACHE_DIR, '*.deb')):
+            # shutil.move renames the .debs, only copying them if target_dir
+            # is on another file system
+            for deb in apt_utils.list_debs(self.APT_CACHE_DIR):
                 shutil.move(deb, target_dir)
 
-    def find_package_objs(self, names, **kwargs):
-        """Wrapper for debian_crossgrader.utils.apt's find_package_objs,
-        passing in the instance's cache."""
-        return apt_utils.find_package_objs(names, self._apt_cache, **kwargs)
+    def _fetch_unmarked_debs(self, targets):
+        """Downloads the candidate .debs of the given packages.
+
+        Used for packages that could not be marked for install. The packages are fetched
+        one at a time, as fetch_binary shares the cache's package records and runs its own
+        apt_pkg.Acquire, which must not run concurrently. A failed download does not stop
+        the other downloads; all failures are raised together afterwards.
 
+        Args:
+            targets: A list of apt.package.Package objects to download.
+
+        Raises:
+            PackageDownloadError: At least one package could not be downloaded.
+        """
+        print('Downloading {} packages that could not be marked for install...'.format(
+            len(targets)))
+        failed = []
+        for target in targets:
+            try:
+                target.candidate.fetch_binary(self.APT_CACHE_DIR)
+            except apt.package.FetchError as error:
+                print('Could not download {}: {}'.format(target.fullname, error))
+                failed.append(target.fullname)
 
-    def _is_first_stage_target(self, package):
-        """Returns a boolean of whether or not the apt.package.Package is a first stage target.
+        if failed:
+            raise PackageDownloadError(failed)
 
-        A first stage target is a package with Priority: required/important.
+    @staticmethod
+    def _link_deb(source, destination):
+        """Hard links the .deb at source to destination.
 
-        This function does not check if the package has installed initramfs hooks.
+        The .deb is not copied if they are on different file systems, as the copy would
+        take up space that is not accounted for.
 
-        Without first stage targets being crossgraded, the system will fail to reboot to the
-        new architecture or will be useless after reboot.
+        Returns:
+            True if the .deb was linked, False if source and destination are on
+            different file systems.
         """
-        if not package.is_installed:
+        try:
+            os.link(source, destination)
+        except OSError as error:
+            if error.errno != errno.EXDEV:
+                raise
             return False
 
-        # do not use package.architecture() because Architecture: all packages
-        # returns the native architecture
-        if package.installed.architecture in ('all', self.target_arch):
+        return True
+
+    @staticmethod
+    def _deb_matches(deb_path, version):
+        """Returns whether the .deb at deb_path has the SHA256 hash of the given
+        apt.package.Version."""
+        expected_hash = version.sha256
+        if not expected_hash:
             return False
 
-        if package.installed.priority in ('required', 'important'):
-            return True
+        deb_hash = hashlib.sha256()
+        with open(deb_path, 'rb') as deb_file:
+            for block in iter(lambda: deb_file.read(1024 * 1024), b''):
+                deb_hash.update(block)
 
-        return False
+        return deb_hash.hexdigest() == expected_hash
+
+    def _restore_cached_debs(self, debs):
+        """Links .debs kept by earlier runs into APT's archives directory.
+
+        Cached .debs that do not match the expected hash, or that are other versions of
+        the requested packages, are removed.
+
+        Args:
+            debs: A list of (file name, apt.package.Version) tuples of the .debs to restore.
+        """
+        if not os.path.isdir(self.deb_cache_path):
+            return
+
+        # archive names are in the form name_version_arch.deb, with any '_' in them quoted
+        requested = {tuple(name.split('_')[0::2]): name for name, __ in debs}
+        for name in os.listdir(self.deb_cache_path):
+            # drop other versions of the requested packages, they will not be used again
+            if requested.get(tuple(name.split('_')[0::2]), name) != name:
+                os.remove(os.path.join(self.deb_cache_path, name))
+
+        restored = 0
+        for name, version in debs:
+            cached_deb = os.path.join(self.deb_cache_path, name)
+            if not os.path.isfile(cached_deb):
+                continue
 
-    def _get_initramfs_hook_packages(self, ignore_initramfs_remnants=False):
+            if not self._deb_matches(cached_deb, version):
+                os.remove(cached_deb)
+                continue
+
+            if self._link_deb(cached_deb, os.path.join(self.APT_CACHE_DIR, name)):
+                restored += 1
+
+        if restored:
+            print('Reusing {} .debs downloaded by a previous run.'.format(restored))
+
+    def _store_cached_debs(self):
+        """Links all .debs in APT's archives directory into deb_cache_path.
+
+        Nothing is cached if deb_cache_path is on a different file system than APT's
+        archives directory.
+        """
+        os.makedirs(self.deb_cache_path, exist_ok=True)
+        for deb in apt_utils.list_debs(self.APT_CACHE_DIR):
+            cached_deb = os.path.join(self.deb_cache_path, os.path.basename(deb))
+            if os.path.exists(cached_deb):
+                continue
+
+            if not self._link_deb(deb, cached_deb):
+                print('{} is on a different file system than {}, not caching .debs.'.format(
+                    self.deb_cache_path, self.APT_CACHE_DIR))
+                return
+
+    def _forget_cached_debs(self, debs):
+        """Removes the cached copies of the given .debs from deb_cache_path.
+
+        Args:
+            debs: An iterable of paths to .debs, matched with the cache by file name.
+        """
+        for deb in debs:
+            try:
+                os.remove(os.path.join(self.deb_cache_path, os.path.basename(deb)))
+            except FileNotFoundError:
+                pass
+
+    @classmethod
+    def clear_deb_cache(cls):
+        """Removes all .debs kept by earlier runs."""
+        if os.path.isdir(cls.deb_cache_path):
+            shutil.rmtree(cls.deb_cache_path)
+
+    def find_package_objs(self, names, **kwargs):
+        """Wrapper for debian_crossgrader.utils.apt's find_package_objs,
+        passing in the instance's cache and package lookups."""
+        return apt_utils.find_package_objs(names, self._apt_cache,
+                                           lookup_cache=self._package_lookup, **kwargs)
+
+    def find_package_objs_by_arch(self, name_arch_pairs, **kwargs):
+        """Wrapper for debian_crossgrader.utils.apt's find_package_objs_by_arch,
+        passing in the instance's cache and package lookups."""
+        return apt_utils.find_package_objs_by_arch(name_arch_pairs, self._apt_cache,
+                                                   lookup_cache=self._package_lookup, **kwargs)
+
+
+    def _get_owner_architecture(self, name, installed_archs, contents):
+        """Returns the architecture of a package that dpkg-query -S listed as owning a file.
+
+        Args:
+            name: Package name outputted by dpkg-query -S.
+            installed_archs: A dict of installed package names and full names
+                to their architectures.
+            contents: Description of the file owned by the package, used in warnings.
+
+        Returns:
+            The architecture of the package, or None if the name is not a package
+            (e.g. a diversion).
+        """
+        architecture = installed_archs.get(name)
+        if architecture is not None:
+            return architecture
+
+        # handle output that might not be packages (e.g. diversions)
+        if name not in self._apt_cache:
+            return None
+
+        package = self._apt_cache[name]
+        print(('WARNING: {}, containing {}, '
+               'is marked as not fully installed.').format(package, contents))
+        print('Assuming it is installed.')
+        return package.candidate.architecture
+
+    def _list_initramfs_hooks(self):
+        """Returns a set of paths to all installed initramfs hooks."""
+        # same as glob('hooks/*'), without matching every entry against a pattern
+        try:
+            return {os.path.join(self.INITRAMFS_HOOKS_DIR, name)
+                    for name in os.listdir(self.INITRAMFS_HOOKS_DIR)
+                    if not name.startswith('.')}
+        except FileNotFoundError:
+            return set()
+
+    def _get_initramfs_hook_packages(self, installed_archs, hooks, file_owners,
+                                     ignore_initramfs_remnants=False):
         """Returns a set of packages shortnames that contain initramfs hooks.
 
+        Args:
+            installed_archs: A dict of installed package names and full names
+                to their architectures.
+            hooks: A set of paths to the initramfs hooks to check.
+            file_owners: A dict of paths to the names of the packages containing them,
+                as outputted by dpkg-query -S.
+            ignore_initramfs_remnants: If true, do not raise a RemnantInitramfsHooksError if
+                there are initramfs hooks that could not be linked.
+
         Raises:
             RemnantInitramfsHooksError: Some initramfs hooks could not be matched with a package.
         """
         out_names = set()
+        unaccounted_hooks = set(hooks)
 
-        unaccounted_hooks = set(glob('/usr/share/initramfs-tools/hooks/*'))
-        hook_pkgs = apt_utils.iter_packages_containing_files(
-            self._apt_cache, '/usr/share/initramfs-tools/hooks/*'
-        )
-
-        for package, hook_file in hook_pkgs:
-            if hook_file not in unaccounted_hooks:
-                print(('Expected {} to contain an initramfs hook, '
-                       'but it does not.').format(package.fullname))
-                print('Skipping.')
-                continue
-
-            unaccounted_hooks.discard(hook_file)
+        for hook_file in hooks:
+            for name in file_owners.get(hook_file, ()):
+                architecture = self._get_owner_architecture(name, installed_archs,
+                                                            'an initramfs hook')
+                if architecture is None:
+                    continue
 
-            if not package.is_installed:
-                print(('WARNING: {}, containing an initramfs hook, '
-                       'is marked as not fully installed.').format(package))
-                print('Assuming it is installed.')
-                architecture = package.candidate.architecture
-            else:
-                architecture = package.installed.architecture
+                unaccounted_hooks.discard(hook_file)
 
-            if architecture not in ('all', self.target_arch):
-                out_names.add(package.shortname)
+                if architecture not in self._skipped_archs:
+                    out_names.add(name.partition(':')[0])
 
         if unaccounted_hooks and not ignore_initramfs_remnants:
             raise RemnantInitramfsHooksError(unaccounted_hooks)
@@ -675,7 +1108,7 @@ class Crossgrader:
         return out_names
 
     def list_first_stage_targets(self, ignore_initramfs_remnants=False,
-                                 ignore_unavailable_targets=False):
+                                 ignore_unavailable_targets=False, collect_hook_targets=True):
         """Returns a list of apt.package.Package objects that must be crossgraded before reboot.
 
         Retrieves and returns a list of all packages with Priority: required/important,
@@ -687,6 +1120,8 @@ class Crossgrader:
                 there are initramfs hooks that could not be linked.
             ignore_unavailable_targets: If true, do not raise a PackageNotFoundError if a package
                 could not be found in the target architecture.
+            collect_hook_targets: If false and ignore_initramfs_remnants is true, do not
+                crossgrade packages containing initramfs hooks.
 
         Raises:
             RemnantInitramfsHooksError: Some initramfs hooks could not be matched with a package.
@@ -694,9 +1129,45 @@ class Crossgrader:
                 in APT's cache.
         """
 
-        targets = {pkg.shortname for pkg in apt_utils.iter_package_objs(self._apt_cache)
-                   if self._is_first_stage_target(pkg)}
-        targets |= self._get_initramfs_hook_packages(ignore_initramfs_remnants)
+        # nothing to check or collect if remnants are ignored and hooks are not collected
+        if ignore_initramfs_remnants and not collect_hook_targets:
+            hooks = set()
+        else:
+            hooks = self._list_initramfs_hooks()
+        shells = shells_utils.list_shells()
+
+        # the installed packages and the owners of the hooks and login shells come from
+        # independent dpkg-query calls, so run them concurrently
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            # read priorities and architectures through dpkg-query instead of python-apt,
+            # which is much slower when accessing every installed package
+            package_info_query = executor.submit(apt_utils.get_installed_package_info,
+                                                 'Priority')
+
+            # look up the owners of the hooks and login shells with a single dpkg-query -S call
+            # query the files found instead of letting dpkg-query match a wildcard
+            # against every file it knows of
+            file_owners = collections.defaultdict(list)
+            for name, filename in apt_utils.iter_package_names_containing_files(
+                    *sorted(hooks.union(shells))):
+                file_owners[filename].append(name)
+
+            package_info = package_info_query.result()
+
+        # without packages with Priority: required/important being crossgraded, the system
+        # will fail to reboot to the new architecture or will be useless after reboot
+        # check the priority first, few installed packages are required/important
+        targets = {name for name, arch, priority in package_info
+                   if priority in self.FIRST_STAGE_PRIORITIES
+                   and arch not in self._skipped_archs}
+
+        # dpkg-query -S outputs names with the architecture if there are several instances
+        installed_archs = {name: arch for name, arch, __ in package_info}
+        installed_archs.update((name + ':' + arch, arch)
+                               for name, arch, __ in package_info)
+
+        targets |= self._get_initramfs_hook_packages(installed_archs, hooks, file_owners,
+                                                     ignore_initramfs_remnants)
 
         # crossgrade crossgrader dependencies
         # if python-apt is not crossgraded, it will not find any packages other than
@@ -710,31 +1181,28 @@ class Crossgrader:
             if not crossgrader_pkg.is_installed:
                 targets.update(self.FALLBACK_CROSSGRADER_DEPENDENCIES)
             else:
-                for dep in crossgrader_pkg.installed.dependencies:
-                    targets.update(ver.package.shortname for ver in dep.installed_target_versions
-                                   if ver.architecture not in ('all', self.target_arch))
+                targets.update(ver.package.shortname
+                               for dep in crossgrader_pkg.installed.dependencies
+                               for ver in dep.installed_target_versions
+                               if ver.architecture not in self._skipped_archs)
 
         # crossgrade all available login shells
         # if login shell is not crossgrader and isn't priority: required (e.g. zsh), then the user
         # cannot login
-        shells = shells_utils.list_shells()
-        for package, __ in apt_utils.iter_packages_containing_files(self._apt_cache, *shells):
-            if not package.is_installed:
-                print(('WARNING: {}, containing a login shell, '
-                       'is marked as not fully installed.').format(package))
-                print('Assuming it is installed.')
-                architecture = package.candidate.architecture
-            else:
-                architecture = package.installed.architecture
-
-            if architecture not in ('all', self.target_arch):
-                targets.add(package.shortname)
+        for shell in shells:
+            for name in file_owners.get(shell, ()):
+                architecture = self._get_owner_architecture(name, installed_archs,
+                                                            'a login shell')
+                if architecture is not None and architecture not in self._skipped_archs:
+                    targets.add(name.partition(':')[0])
 
         targets.add('sudo')
 
-        return self.find_package_objs(targets, default_arch=self.target_arch,
-                                      ignore_unavailable_targets=ignore_unavailable_targets,
-                                      ignore_installed=True)
+        return self.find_package_objs_by_arch(
+            ((name, self.target_arch) for name in targets),
+            ignore_unavailable_targets=ignore_unavailable_targets,
+            ignore_installed=True
+        )
 
     def list_second_stage_targets(self, ignore_unavailable_targets):
         """Returns a list of apt.package.Package objects that are not in the target architecture.
@@ -747,14 +1215,13 @@ class Crossgrader:
             PackageNotFoundError: A required package in the target architecture was not available
                 in APT's cache.
         """
-        targets = set()
-        for pkg in apt_utils.iter_package_objs(self._apt_cache):
-            if not pkg.is_installed:
-                continue
-
-            if pkg.installed.architecture not in ('all', self.target_arch):
-                targets.add(pkg.shortname)
-
-        return self.find_package_objs(targets, default_arch=self.target_arch,
-                                      ignore_unavailable_targets=ignore_unavailable_targets,
-                                      ignore_installed=True)
+        # dpkg already knows the status and architecture of each package, so only the
+        # targets have to be looked up in APT's cache
+        targets = {name for name, arch in apt_utils.get_installed_package_info()
+                   if arch not in self._skipped_archs}
+
+        return self.find_package_objs_by_arch(
+            ((name, self.target_arch) for name in targets),
+            ignore_unavailable_targets=ignore_unavailable_targets,
+            ignore_installed=True
+        )
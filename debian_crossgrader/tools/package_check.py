@@ -8,64 +8,92 @@ import sys
 
 import appdirs
 
+PACKAGE_QUERY = ['dpkg-query', '-f', '${Package}\t${Architecture}\t${Status}\n', '-W']
+
+def _query_packages():
+    """Returns a dict of the current system's packages, as in package_list_to_dict."""
+    # parse dpkg-query's output as it is produced instead of buffering it
+    proc = subprocess.Popen(PACKAGE_QUERY, stdout=subprocess.PIPE)
+    packages = package_list_to_dict(proc.stdout)
+    proc.stdout.close()
+
+    ret_code = proc.wait()
+    if ret_code != 0:
+        raise subprocess.CalledProcessError(ret_code, PACKAGE_QUERY)
+
+    return packages
+
 def save_package_list(output_file):
-    """Saves your currently installed packages to the given file path."""
+    """Saves your currently installed packages to the given file path.
+
+    Args:
+        output_file: Path of the file to create.
+    """
     print('Saving currently installed packages...')
-    assert not os.path.isfile(output_file)
 
-    package_info = subprocess.check_output(['dpkg-query', '-f',
-                                            '${Package}\t${Architecture}\t${Status}\n', '-W'],
-                                           universal_newlines=True)
+    # 'x' fails if the file exists, without a separate check beforehand
+    try:
+        packages_file = open(output_file, 'xb')
+    except FileExistsError:
+        raise FileExistsError('{} already exists, not overwriting it.'.format(output_file))
+
+    with packages_file:
+        # the list is copied verbatim, so there is no need to decode it
+        proc = subprocess.Popen(PACKAGE_QUERY, stdout=subprocess.PIPE)
+        shutil.copyfileobj(proc.stdout, packages_file)
+        proc.stdout.close()
 
-    with open(output_file, 'w') as packages_file:
-        packages_file.write(package_info)
+        ret_code = proc.wait()
+        if ret_code != 0:
+            raise subprocess.CalledProcessError(ret_code, PACKAGE_QUERY)
 
     print('Packages saved.')
 
 def package_list_to_dict(contents):
     """Returns a dict version of a list containing package information.
 
-    Each entry should be in the form Package\tArchitecture\tStatus.
+    Each entry should be bytes in the form Package\tArchitecture\tStatus, optionally
+    followed by a newline. The keys (Package:Architecture) and values (Status) of
+    the dict are bytes as well, as the list does not need to be decoded to be compared.
     """
-    packages = {}
-    for package_info in contents:
-        name, arch, status = package_info.split('\t')
-        packages['{}:{}'.format(name, arch)] = status
-
-    return packages
+    fields = (package_info.rstrip(b'\n').split(b'\t') for package_info in contents)
+    return {name + b':' + arch: status for name, arch, status in fields}
 
 
 def compare_package_list(input_file):
-    """Compares your installed packages to list in the given file."""
-    assert os.path.isfile(input_file)
-
-    curr_arch = subprocess.check_output(['dpkg', '--print-architecture'],
-                                        universal_newlines=True).strip()
+    """Compares your installed packages to list in the given file.
 
-    curr_packages = subprocess.check_output(['dpkg-query', '-f',
-                                             '${Package}\t${Architecture}\t${Status}\n', '-W'],
-                                            universal_newlines=True).splitlines()
-    curr_packages = package_list_to_dict(curr_packages)
+    Args:
+        input_file: Path of a file created by save_package_list.
+    """
+    assert os.path.isfile(input_file)
 
-    with open(input_file, 'r') as packages_file:
-        old_packages = package_list_to_dict(packages_file.read().splitlines())
+    curr_arch = subprocess.check_output(['dpkg', '--print-architecture']).strip()
 
-    for package, status in old_packages.items():
-        name, arch = package.split(':')
+    curr_packages = _query_packages()
 
-        if status != 'install ok installed':
-            continue
+    installed_status = b'install ok installed'
+    curr_arch_suffix = b':' + curr_arch
 
-        target_package = package if arch == 'all' else '{}:{}'.format(name, curr_arch)
+    # stream the saved list, only keeping the packages that are missing now
+    # packages are expected to be in the current architecture unless they are arch: all
+    missing_packages = set()
+    with open(input_file, 'rb') as packages_file:
+        for package_info in packages_file:
+            name, arch, status = package_info.rstrip(b'\n').split(b'\t')
+            if status != installed_status:
+                continue
 
-        if target_package not in curr_packages:
-            found = False
-        else:
-            found = curr_packages[target_package] == 'install ok installed'
+            if arch == b'all':
+                expected_package = name + b':all'
+            else:
+                expected_package = name + curr_arch_suffix
+            if curr_packages.get(expected_package) != installed_status:
+                missing_packages.add(expected_package)
 
-        if not found:
-            print('{} is not installed in the target arch.'.format(target_package),
-                  file=sys.stderr)
+    for target_package in sorted(missing_packages):
+        print('{} is not installed in the target arch.'.format(os.fsdecode(target_package)),
+              file=sys.stderr)
 
 
 def get_argparser():
@@ -1,11 +1,14 @@
 """Tool to install a given number of random packages from dpkg."""
 import argparse
 import random
+import sys
 
 from apt import apt_pkg
 import apt
 import apt.progress
 
+from debian_crossgrader.utils import apt as apt_utils
+
 def install_random(num_packages, choice_func=None):
     """Install a given number of random packages, not including dependencies.
 
@@ -14,31 +17,34 @@ def install_random(num_packages, choice_func=None):
     """
     cache = apt.cache.Cache()
 
-    candidates = []
-    for package in cache.keys():
-        package_obj = cache[package]
-        if package_obj.is_installed:
-            continue
-        if choice_func is not None and not choice_func(package_obj):
-            continue
-
-        candidates.append(package)
+    candidates = [package for package in cache if not apt_utils.is_installed(package)
+                  and (choice_func is None or choice_func(package))]
 
+    marked_messages = []
     while num_packages > 0:
+        # swap the choice with the last candidate so it can be popped in constant time
         choice_idx = random.randrange(len(candidates))
-        package = candidates.pop(choice_idx)
+        candidates[choice_idx], candidates[-1] = candidates[-1], candidates[choice_idx]
+        package = candidates.pop()
 
         try:
-            cache[package].mark_install()
+            package.mark_install()
         except apt_pkg.Error:
             pass
 
-        if cache[package].marked_install:
-            print('{} marked for install'.format(package))
+        if package.marked_install:
+            marked_messages.append('{} marked for install\n'.format(package.name))
             num_packages -= 1
 
-    cache.commit(apt.progress.text.AcquireProgress(),
-                 apt.progress.base.InstallProgress())
+    sys.stdout.write(''.join(marked_messages))
+
+    # only report download progress to a terminal
+    if sys.stdout.isatty():
+        acquire_progress = apt.progress.text.AcquireProgress()
+    else:
+        acquire_progress = apt.progress.base.AcquireProgress()
+
+    cache.commit(acquire_progress, apt.progress.base.InstallProgress())
 
 
 def main():
@@ -1,7 +1,13 @@
 """Functions for querying packages from dpkg"""
 
+import os
 import subprocess
 
+import apt_inst
+import apt_pkg
+
+from debian_crossgrader.utils import cmd as cmd_utils
+
 class PackageNotFoundError(Exception):
     """Raised when a package does not exist in APT's cache.
 
@@ -14,52 +20,157 @@ class PackageNotFoundError(Exception):
         self.package = package
 
 
+def is_installed(package):
+    """Returns whether the given apt.package.Package is installed.
+
+    Same as Package.is_installed, but reads the underlying apt_pkg.Package directly,
+    skipping the wrapper's property lookups in loops over many packages.
+    """
+    return package._pkg.current_ver is not None  # pylint: disable=protected-access
+
+def _iter_dpkg_query_lines(query_format):
+    """Generator of the lines outputted by dpkg-query -W with the given format.
+
+    The output is read while dpkg-query runs, instead of being held in memory at once.
+
+    Raises:
+        subprocess.CalledProcessError: dpkg-query exited with a non-zero exit code.
+    """
+    query_cmd = ['dpkg-query', '-f', query_format, '-W']
+    with subprocess.Popen(query_cmd, stdout=subprocess.PIPE,
+                          universal_newlines=True) as proc:
+        for line in proc.stdout:
+            yield line.rstrip('\n')
+
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, query_cmd)
+
 def get_package_fullnames():
     """Returns the full names (name:arch) of all packages on the current system."""
-    return subprocess.check_output(['dpkg-query', '-f', '${Package}:${Architecture}\n', '-W'],
-                                   universal_newlines=True).splitlines()
+    return list(_iter_dpkg_query_lines('${Package}:${Architecture}\n'))
 
 def get_arch_packages(arch):
     """Returns the full names of all the packages with the given architecture."""
-    return [pkg for pkg in get_package_fullnames() if pkg.split(':')[1] == arch]
+    # the architecture is always the part after the last colon
+    suffix = ':' + arch
+    return [pkg for pkg in get_package_fullnames() if pkg.endswith(suffix)]
 
-def iter_package_objs(apt_cache):
-    """Generator of all packages existing on the current system.
+def get_installed_package_info(*fields):
+    """Returns a list of (name, architecture, *fields) tuples for all installed packages.
 
     Args:
-        apt_cache: APT cache to get package objects
+        fields: Names of additional dpkg-query fields to include for each package
+            (e.g. Priority)
     """
+    query_format = '\t'.join(['${Package}', '${Architecture}', '${Status}'] +
+                             ['${{{}}}'.format(field) for field in fields]) + '\n'
+    package_info = []
+    for line in _iter_dpkg_query_lines(query_format):
+        name, arch, status, *values = line.split('\t')
+        # same as python-apt's Package.is_installed
+        if status.rsplit(' ', 1)[-1] in ('not-installed', 'config-files'):
+            continue
 
-    # looping through the APT cache using python-apt takes 10+ seconds on
-    # some systems, whereas dpkg-query instead takes <1 second
-    for fullname in get_package_fullnames():
-        yield apt_cache[fullname]
-
-def iter_packages_containing_files(apt_cache, *filename_patterns):
-    """Generator of a tuple of (package_object, filename) outputted
-    by dpkg-query -S filename_patterns."""
-    # possible erroring out, use popen
-    proc = subprocess.Popen(['dpkg-query', '-S'] + list(filename_patterns),
-                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
-                            universal_newlines=True)
-    query_out_lines, __ = proc.communicate()
-    query_out_lines = query_out_lines.splitlines()
-
-    for query_out_line in query_out_lines:
-        # yikes... how can I do this without depending on dpkg-query output format?
-        names, filename = query_out_line.split(': ')
-
-        for name in names.split(', '):
-            # handle output that might not be packages (e.g. diversions)
-            try:
-                package = apt_cache[name]
-            except KeyError:
-                continue
+        package_info.append((name, arch) + tuple(values))
+
+    return package_info
+
+def get_auto_installed_fullnames():
+    """Returns the full names (name:arch) of all packages marked as automatically installed.
+
+    Reads APT's extended_states file, where apt-mark stores the marks, instead of
+    running apt-mark showauto.
+    """
+    # entries written before multiarch do not have an architecture
+    native_arch = apt_pkg.config.find('APT::Architecture')
+
+    auto_fullnames = set()
+    try:
+        with open(apt_pkg.config.find_file('Dir::State::extended_states')) as states_file:
+            for section in apt_pkg.TagFile(states_file):
+                if section.get('Auto-Installed') == '1':
+                    auto_fullnames.add(section['Package'] + ':'
+                                       + section.get('Architecture', native_arch))
+    except FileNotFoundError:
+        pass
+
+    return auto_fullnames
+
+def get_deb_fullname(deb_path):
+    """Returns the full name (name:arch) of the package contained in the given .deb file.
+
+    The control file is read in-process; dpkg-deb -W only accepts a single archive,
+    so it would have to be run once per .deb.
+    """
+    control = apt_inst.DebFile(deb_path).control.extractdata('control')
+    control = apt_pkg.TagSection(control)
+    return '{}:{}'.format(control['Package'], control['Architecture'])
+
+def list_debs(directory):
+    """Returns the paths of all .deb files in the given directory.
+
+    Equivalent to glob(os.path.join(directory, '*.deb')), without matching
+    every entry against a pattern.
+
+    Args:
+        directory: Directory to list
+    Returns:
+        A list of paths, or an empty list if the directory does not exist.
+    """
+    # os.scandir is not available in Python 3.4
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+
+    return [os.path.join(directory, name) for name in names
+            if name.endswith('.deb') and not name.startswith('.')]
+
+def _quote_archive_name_part(part, bad_chars):
+    """Quotes part of an archive file name the same way as APT's QuoteString."""
+    return ''.join('%{:02x}'.format(ord(char))
+                   if char in bad_chars or char in '% ' or not 0x20 < ord(char) < 0x7f
+                   else char
+                   for char in part)
+
+def get_archive_filename(version):
+    """Returns the name APT stores the .deb of the given apt.package.Version under
+    in its archives directory.
 
-            yield (package, filename)
+    It differs from the file name in the repository if the version has an epoch.
+    """
+    extension = version.filename.rsplit('.', 1)[-1]
+    return '{}_{}_{}.{}'.format(_quote_archive_name_part(version.package.shortname, '_:'),
+                                _quote_archive_name_part(version.version, '_:'),
+                                _quote_archive_name_part(version.architecture, '_:.'),
+                                extension)
+
+def iter_package_names_containing_files(*filename_patterns):
+    """Generator of a tuple of (package_name, filename) outputted
+    by dpkg-query -S filename_patterns.
+
+    The names are not checked against any cache, so they might not be packages
+    (e.g. diversions).
+
+    Passing exact paths instead of wildcard patterns is much faster, as dpkg-query can
+    look them up directly instead of matching every file it knows of.
+    """
+    query_cmd = ['dpkg-query', '-S', '--']
+    for patterns in cmd_utils.chunk_args(list(filename_patterns), query_cmd):
+        # possible erroring out (e.g. paths not owned by any package), use popen
+        # and parse the output while dpkg-query runs
+        with subprocess.Popen(query_cmd + patterns,
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                              universal_newlines=True) as proc:
+            for query_out_line in proc.stdout:
+                # yikes... how can I do this without depending on dpkg-query output format?
+                names, filename = query_out_line.rstrip('\n').split(': ')
+
+                for name in names.split(', '):
+                    yield (name, filename)
 
 def find_package_objs(names, apt_cache, default_arch=None, ignore_unavailable_targets=False,
-                      ignore_installed=False):
+                      ignore_installed=False, lookup_cache=None, resolve_virtual=False):
     """Returns a list of apt.package.Package objects corresponding to the given names.
 
     Args:
@@ -69,28 +180,91 @@ def find_package_objs(names, apt_cache, default_arch=None, ignore_unavailable_ta
         ignore_unavailable_targets: If true, ignore names that have no corresponding
             packages
         ignore_installed: If true, ignore packages that are already installed.
+        lookup_cache: See find_package_objs_by_arch.
+        resolve_virtual: See find_package_objs_by_arch.
 
     Raises:
         PackageNotFoundError: A package requested was not available in APT's cache.
     """
-    packages = []
+    name_arch_pairs = []
     for name in names:
-        if ':' in name:
-            pkg_name, arch = name.split(':')
-        else:
-            pkg_name = name
-            arch = default_arch
+        pkg_name, sep, arch = name.partition(':')
+        name_arch_pairs.append((pkg_name, arch if sep else default_arch))
+
+    return find_package_objs_by_arch(name_arch_pairs, apt_cache,
+                                     ignore_unavailable_targets=ignore_unavailable_targets,
+                                     ignore_installed=ignore_installed,
+                                     lookup_cache=lookup_cache,
+                                     resolve_virtual=resolve_virtual)
+
+def find_package_objs_by_arch(name_arch_pairs, apt_cache, ignore_unavailable_targets=False,
+                              ignore_installed=False, lookup_cache=None,
+                              resolve_virtual=False):
+    """Returns a list of apt.package.Package objects corresponding to the given names
+    and architectures.
+
+    Args:
+        name_arch_pairs: An iterable of (package name, architecture) tuples. If the
+            architecture is None, the package's name is looked up as is.
+        apt_cache: APT cache to get package objects
+        ignore_unavailable_targets: If true, ignore names that have no corresponding
+            packages
+        ignore_installed: If true, ignore packages that are already installed.
+        lookup_cache: A dict of package names to apt.package.Package objects that were
+            already looked up in apt_cache. Found packages are added to it. It must be
+            cleared when apt_cache is re-opened.
+        resolve_virtual: If true, names that are only provided by a single package
+            in the given architecture (e.g. virtual packages of renamed packages) are
+            resolved to that package. Only use this for names given by the user, as
+            the package that is crossgraded is then not the one that was named.
 
-        target_name = '{}:{}'.format(pkg_name, arch) if arch is not None else name
+    Raises:
+        PackageNotFoundError: A package requested was not available in APT's cache.
+    """
+    packages = []
+    for pkg_name, arch in name_arch_pairs:
+        target_name = '{}:{}'.format(pkg_name, arch) if arch is not None else pkg_name
 
-        try:
-            package = apt_cache[target_name]
-            if not ignore_installed or not package.is_installed:
-                packages.append(package)
-        except KeyError:
-            if not ignore_unavailable_targets:
-                raise PackageNotFoundError(target_name)
+        package = lookup_cache.get(target_name) if lookup_cache is not None else None
+        if package is None:
+            # membership test instead of catching KeyError, many targets may be missing
+            if target_name in apt_cache:
+                package = apt_cache[target_name]
+                if lookup_cache is not None:
+                    lookup_cache[target_name] = package
+            elif resolve_virtual:
+                # not remembered, so lookups without resolve_virtual never get the provider
+                package = _find_provider(apt_cache, target_name, arch)
 
-            print("Couldn't find {}, ignoring...".format(target_name))
+            if package is None:
+                if not ignore_unavailable_targets:
+                    raise PackageNotFoundError(target_name)
+
+                print("Couldn't find {}, ignoring...".format(target_name))
+                continue
+
+        if not ignore_installed or not is_installed(package):
+            packages.append(package)
 
     return packages
+
+def _find_provider(apt_cache, name, arch=None):
+    """Returns the only package providing the virtual package name, or None.
+
+    Args:
+        apt_cache: APT cache to get package objects
+        name: Name of the virtual package
+        arch: If not None, only consider providing packages of this architecture.
+    """
+    if not apt_cache.is_virtual_package(name):
+        return None
+
+    providers = [package for package in apt_cache.get_providing_packages(name)
+                 if arch is None or package.architecture() == arch]
+
+    # do not guess between multiple providers
+    if len(providers) != 1:
+        return None
+
+    print('{} is a virtual package, using {}.'.format(name, providers[0].fullname))
+    return providers[0]
@@ -1,81 +1,75 @@
 """Functions to make calling shell commands easier."""
 
-import fcntl
 import os
+import struct
 import sys
-import select
 
-def tee_process(process):
-    """Outputs the process' stdout and stderr to stdout while recording it.
+POINTER_SIZE = struct.calcsize('P')
 
-    Ideas and code from https://stackoverflow.com/a/7730201 and
-    https://github.com/catapult-project/catapult/blob/master/devil/devil/utils/cmd_helper.py#L214.
+def tee_stderr_lines(process, line_callback):
+    """Outputs the process' stderr to stderr line by line, passing each line to a callback.
+
+    The output is not recorded, so memory usage stays constant no matter how much the
+    process outputs, and lines can be handled while the process runs.
 
     Args:
-        process: subprocess.Popen object representing the process. Its stdout
-            and stderr should be set to subprocess.PIPE.
+        process: subprocess.Popen object representing the process. Its stderr
+            should be set to subprocess.PIPE. Its stdout should not be a pipe,
+            otherwise the process might block on a full stdout pipe.
+        line_callback: Function called with each line of stderr as it is read,
+            as bytes unless the process was started in text mode.
     Returns:
-        A tuple in the form of (exit_code, stdout, stderr).
+        The exit code of the process.
     """
-
-    def make_async(child_fd):
-        """Add the O_NONBLOCK flag to a file description"""
-        file_status = fcntl.fcntl(child_fd, fcntl.F_GETFL)
-        fcntl.fcntl(child_fd, fcntl.F_SETFL, file_status | os.O_NONBLOCK)
-
-    def write_contents(child_fds, output_dict, is_text):
-        """Write contents of file descriptors to stdout and output_dict.
-
-        Returns:
-            True if any data was read, False otherwise.
-        """
-        data_read = False
-        for child_fd in child_fds:
-            data = child_fd.read()
-
-            if data:
-                data_read = True
-
-                if is_text:
-                    sys.stdout.write(data)
-                else:
-                    sys.stdout.buffer.write(data)
-                    sys.stdout.flush()
-
-                output_dict[child_fd.fileno()].append(data)
-
-        return data_read
-
-
     try:
         text_mode = process.text_mode
     except AttributeError:  # workaround for Python 3.5
         text_mode = process.universal_newlines
 
-    # stdout/stderr can be None if they are set to sys.stdout/sys.stderr
-    process_outs = []
-    if process.stdout is not None:
-        make_async(process.stdout)
-        process_outs.append(process.stdout)
-    if process.stderr is not None:
-        make_async(process.stderr)
-        process_outs.append(process.stderr)
-
-    output_bufs = {proc_fd.fileno(): [] for proc_fd in process_outs}
+    if text_mode:
+        output = sys.stderr
+    else:
+        sys.stderr.flush()
+        output = sys.stderr.buffer
 
-    while True:
-        read_fds, __, __ = select.select(process_outs, [], [], 1)
-        has_data = write_contents(read_fds, output_bufs, text_mode)
+    for line in process.stderr:
+        output.write(line)
+        output.flush()
+        line_callback(line)
 
-        if process.poll() is not None and not has_data:
-            break
+    process.stderr.close()
+    return process.wait()
 
-    stdout_data = output_bufs[process.stdout.fileno()] if process.stdout is not None else []
-    stderr_data = output_bufs[process.stderr.fileno()] if process.stderr is not None else []
+def chunk_args(args, base_args=()):
+    """Splits arguments into chunks that each fit within the system's command line limit.
 
-    if text_mode:
-        separator = ''
-    else:
-        separator = b''
-
-    return process.poll(), separator.join(stdout_data), separator.join(stderr_data)
+    Args:
+        args: A list of arguments to split.
+        base_args: The arguments each chunk will be appended to (e.g. ['dpkg', '--purge']).
+    Yields:
+        Lists of consecutive arguments from args.
+    """
+    # each argument costs its length, a null terminator and a pointer in argv
+    def arg_length(arg):
+        return len(os.fsencode(arg)) + 1 + POINTER_SIZE
+
+    # the environment counts towards the limit too, leave some headroom like xargs does
+    max_length = os.sysconf('SC_ARG_MAX') - 2048
+    max_length -= sum(arg_length(key) + len(os.fsencode(value)) + 1
+                      for key, value in os.environ.items())
+    max_length -= sum(arg_length(arg) for arg in base_args)
+
+    chunk = []
+    chunk_length = 0
+    for arg in args:
+        length = arg_length(arg)
+        if chunk and chunk_length + length > max_length:
+            yield chunk
+            chunk = []
+            chunk_length = 0
+
+        chunk.append(arg)
+        chunk_length += length
+
+    if chunk:
+        yield chunk
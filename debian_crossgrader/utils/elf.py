@@ -1,6 +1,12 @@
 """ELF file utilities used by debian_crossgrader."""
+import os
 import struct
 
+ELF_MAGIC = b'\x7fELF'
+# e_machine is the 2-byte field at offset 18 of the ELF header
+E_MACHINE = struct.Struct('H')
+E_MACHINE_OFFSET = 18
+
 
 def e_machine(filename):
     """Returns a 2-byte bytestring of the ELF file's e_machine entry, or None if not an ELF.
@@ -10,16 +16,21 @@ def e_machine(filename):
     """
     # pylint: disable=broad-except
     try:
-        with open(filename, 'rb') as elf:
-            if not elf.read(4) == b'\x7fELF':
-                return None
-
-            elf.seek(18)
-            return struct.unpack('H', elf.read(2))[0]
+        # read the header up to e_machine with a single pread instead of read, seek and read
+        elf_fd = os.open(filename, os.O_RDONLY)
+        try:
+            header = os.pread(elf_fd, E_MACHINE_OFFSET + E_MACHINE.size, 0)
+        finally:
+            os.close(elf_fd)
     except Exception as exc:
         print(exc)
         return None
 
+    if len(header) < E_MACHINE_OFFSET + E_MACHINE.size or not header.startswith(ELF_MAGIC):
+        return None
+
+    return E_MACHINE.unpack_from(header, E_MACHINE_OFFSET)[0]
+
 
 if __name__ == '__main__':
     print(e_machine('/usr/bin/dpkg'))